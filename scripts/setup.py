@@ -148,6 +148,12 @@ def make_cloud_conf(lkp=lkp, cloud_parameters=None):
     if cloud_parameters is None:
         cloud_parameters = lkp.cfg.cloud_parameters
 
+    # node groups commonly share templates, fetch each one once up front
+    lkp.prefetch_templates(
+        node.instance_template
+        for part in lkp.cfg.partitions.values()
+        for node in part.partition_nodes.values()
+    )
     any_gpus = any(
         lkp.template_info(node.instance_template).gpu_count > 0
         for part in cfg.partitions.values()
@@ -200,9 +206,11 @@ def make_cloud_conf(lkp=lkp, cloud_parameters=None):
         }
         return dict_to_conf(conf_options, delim="\n")
 
-    def node_group_lines(node_group, part_name):
+    def node_group_lines(node_group, part_name, zone=None):
         template_info = lkp.template_info(node_group.instance_template)
-        machine_conf = lkp.template_machine_conf(node_group.instance_template)
+        machine_conf = lkp.template_machine_conf(
+            node_group.instance_template, zone=zone
+        )
 
         node_def = dict_to_conf(
             {
@@ -254,14 +262,17 @@ def make_cloud_conf(lkp=lkp, cloud_parameters=None):
     def partitionlines(partition):
         """Make a partition line for the slurm.conf"""
         part_name = partition.partition_name
+        # machine types can be looked up directly in a zone the partition is
+        # allowed to use instead of listing them in every zone
+        zone = next(iter(partition.zone_policy_allow or []), None)
         group_lines = [
-            node_group_lines(group, part_name)
+            node_group_lines(group, part_name, zone=zone)
             for group in partition.partition_nodes.values()
         ]
         nodesets, nodelines = zip(*group_lines)
 
         def defmempercpu(template_link):
-            machine_conf = lkp.template_machine_conf(template_link)
+            machine_conf = lkp.template_machine_conf(template_link, zone=zone)
             return max(100, machine_conf.memory // machine_conf.cpus)
 
         defmem = min(
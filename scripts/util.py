@@ -19,6 +19,7 @@ import importlib.util
 import logging
 import logging.config
 import os
+import random
 import re
 import shelve
 import shlex
@@ -27,10 +28,11 @@ import socket
 import subprocess
 import sys
 import tempfile
+import threading
 from collections import defaultdict, namedtuple
 from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
-from functools import lru_cache, reduce, partialmethod
+from functools import lru_cache, reduce, partial, partialmethod
 from itertools import chain, compress, islice
 from pathlib import Path
 from time import sleep, time
@@ -56,12 +58,23 @@ import googleapiclient.discovery  # noqa: E402
 import google_auth_httplib2  # noqa: E402
 from googleapiclient.http import set_user_agent  # noqa: E402
 
-from requests import get as get_url  # noqa: E402
+from requests import Session  # noqa: E402
+from requests.adapters import HTTPAdapter  # noqa: E402
 from requests.exceptions import RequestException  # noqa: E402
 
 import yaml  # noqa: E402
 from addict import Dict as NSDict  # noqa: E402
 
+# prefer the libyaml C bindings when available
+try:
+    from yaml import CSafeLoader as SafeLoader, CSafeDumper as SafeDumper
+except ImportError:
+    from yaml import SafeLoader, SafeDumper
+
+    logging.getLogger(__name__).warning(
+        "libyaml not available, using the pure Python yaml loader"
+    )
+
 optional_modules = [
     ("google.cloud.pubsub", "google-cloud-pubsub"),
     ("google.cloud.secretmanager", "google-cloud-secret-manager"),
@@ -77,6 +90,7 @@ if ENV_CONFIG_YAML:
 else:
     CONFIG_FILE = Path(__file__).with_name("config.yaml")
 API_REQ_LIMIT = 2000
+MAX_WAIT_WORKERS = 16
 
 log = logging.getLogger(__name__)
 def_creds, project = google.auth.default()
@@ -86,8 +100,6 @@ scripts_dir = next(
     p for p in (Path(__file__).parent, Path("/slurm/scripts")) if p.is_dir()
 )
 
-# readily available compute api handle
-compute = None
 # slurm-gcp config object, could be None if not available
 cfg = None
 # caching Lookup object
@@ -294,9 +306,27 @@ def is_exclusive_node(node):
     )
 
 
+class ThreadLocalHttp(threading.local):
+    """Http handle that keeps a separate Http, and its connection pool, for
+    each thread using it, since httplib2.Http is not thread-safe
+    """
+
+    def __init__(self, credentials=None, user_agent=None):
+        # threading.local runs __init__ again on first use in each thread
+        http = httplib2.Http()
+        if user_agent is not None:
+            http = set_user_agent(http, user_agent)
+        if credentials is not None:
+            http = google_auth_httplib2.AuthorizedHttp(credentials, http=http)
+        self.http = http
+
+    def __getattr__(self, name):
+        return getattr(self.http, name)
+
+
 def compute_service(credentials=None, user_agent=USER_AGENT, version="v1"):
     """Make thread-safe compute service handle
-    creates a new Http for each request
+    reuses one Http (and its connections) per thread
     """
     try:
         key_path = os.environ["GOOGLE_APPLICATION_CREDENTIALS"]
@@ -309,13 +339,11 @@ def compute_service(credentials=None, user_agent=USER_AGENT, version="v1"):
     elif credentials is None:
         credentials = def_creds
 
+    # shared by all requests, but each thread gets its own connections
+    thread_http = ThreadLocalHttp(credentials=credentials, user_agent=user_agent)
+
     def build_request(http, *args, **kwargs):
-        new_http = httplib2.Http()
-        if user_agent is not None:
-            new_http = set_user_agent(new_http, user_agent)
-        if credentials is not None:
-            new_http = google_auth_httplib2.AuthorizedHttp(credentials, http=new_http)
-        return googleapiclient.http.HttpRequest(new_http, *args, **kwargs)
+        return googleapiclient.http.HttpRequest(thread_http, *args, **kwargs)
 
     log.debug(f"Using version={version} of Google Compute Engine API")
     return googleapiclient.discovery.build(
@@ -323,10 +351,35 @@ def compute_service(credentials=None, user_agent=USER_AGENT, version="v1"):
         version,
         requestBuilder=build_request,
         credentials=credentials,
+        # use the discovery document shipped with the client library
+        static_discovery=True,
+        cache_discovery=False,
     )
 
 
-compute = compute_service()
+@lru_cache(maxsize=1)
+def get_compute():
+    """readily available compute api handle, built on first use"""
+    return compute_service()
+
+
+def _api_handles(project=None, compute=None):
+    """resolve project and compute for a call at call time: the ones given,
+    else the module project and util.compute if it was assigned (e.g.
+    resume.py switching to beta), else the lazily built compute handle
+    """
+    project = project or globals()["project"]
+    compute = compute or globals().get("compute") or get_compute()
+    return project, compute
+
+
+def __getattr__(name):
+    """build the module level compute handle lazily, so importing util for
+    config handling alone does not pay for building the service
+    """
+    if name == "compute":
+        return get_compute()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 def load_config_data(config):
@@ -376,7 +429,7 @@ def config_from_metadata():
             break
     else:
         return None
-    cfg = new_config(yaml.safe_load(config_yaml))
+    cfg = new_config(yaml.load(config_yaml, Loader=SafeLoader))
     return cfg
 
 
@@ -384,7 +437,7 @@ def load_config_file(path):
     """load config from file"""
     content = None
     try:
-        content = yaml.safe_load(Path(path).read_text())
+        content = yaml.load(Path(path).read_text(), Loader=SafeLoader)
     except FileNotFoundError:
         log.error(f"config file not found: {path}")
         return None
@@ -392,8 +445,27 @@ def load_config_file(path):
 
 
 def save_config(cfg, path):
-    """save given config to file at path"""
-    Path(path).write_text(yaml.dump(cfg, Dumper=Dumper))
+    """save given config to file at path
+    the config is dumped to a temporary file which then replaces path, so a
+    failed dump never leaves a truncated config behind
+    """
+    path = Path(path)
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.")
+    try:
+        with os.fdopen(fd, "w") as f:
+            yaml.dump(cfg, f, Dumper=Dumper)
+        if path.exists():
+            # keep mode and ownership of the file being replaced
+            st = path.stat()
+            os.chmod(tmp_path, st.st_mode)
+            try:
+                os.chown(tmp_path, st.st_uid, st.st_gid)
+            except PermissionError:
+                pass
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
 
 
 def config_root_logger(
@@ -462,21 +534,24 @@ def handle_exception(exc_type, exc_value, exc_trace):
 
 def run(
     cmd,
-    stdout=subprocess.PIPE,
-    stderr=subprocess.PIPE,
+    capture=True,
     shell=False,
     timeout=None,
     check=True,
     universal_newlines=True,
     **kwargs,
 ):
-    """Wrapper for subprocess.run() with convenient defaults"""
+    """Wrapper for subprocess.run() with convenient defaults
+    cmd may be a string or an argument list, which is used as is
+    stdout/stderr are captured unless capture=False, then they are inherited
+    """
     log.debug(f"run: {cmd}")
-    args = cmd if shell else shlex.split(cmd)
+    if capture:
+        kwargs.setdefault("stdout", subprocess.PIPE)
+        kwargs.setdefault("stderr", subprocess.PIPE)
+    args = cmd if shell or isinstance(cmd, (list, tuple)) else shlex.split(cmd)
     result = subprocess.run(
         args,
-        stdout=stdout,
-        stderr=stderr,
         shell=shell,
         timeout=timeout,
         check=check,
@@ -490,7 +565,7 @@ def spawn(cmd, quiet=False, shell=False, **kwargs):
     """nonblocking spawn of subprocess"""
     if not quiet:
         log.debug(f"spawn: {cmd}")
-    args = cmd if shell else shlex.split(cmd)
+    args = cmd if shell or isinstance(cmd, (list, tuple)) else shlex.split(cmd)
     return subprocess.Popen(args, shell=shell, **kwargs)
 
 
@@ -551,6 +626,19 @@ def chunked(iterable, n=API_REQ_LIMIT):
         yield chunk
 
 
+def ichunked(iterable, n=API_REQ_LIMIT):
+    """group iterator into lazy chunks of max size n
+    each chunk must be consumed before advancing to the next
+    """
+    it = iter(iterable)
+    sentinel = object()
+    while True:
+        first = next(it, sentinel)
+        if first is sentinel:
+            return
+        yield chain((first,), islice(it, n - 1))
+
+
 def groupby_unsorted(seq, key):
     indices = defaultdict(list)
     for i, el in enumerate(seq):
@@ -561,13 +649,17 @@ def groupby_unsorted(seq, key):
 
 ROOT_URL = "http://metadata.google.internal/computeMetadata/v1"
 
+# keep the connection to the metadata server open between requests
+metadata_session = Session()
+metadata_session.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=4))
+
 
 def get_metadata(path, root=ROOT_URL):
     """Get metadata relative to metadata/computeMetadata/v1"""
     HEADERS = {"Metadata-Flavor": "Google"}
     url = f"{root}/{path}"
     try:
-        resp = get_url(url, headers=HEADERS)
+        resp = metadata_session.get(url, headers=HEADERS)
         resp.raise_for_status()
         return resp.text
     except RequestException:
@@ -642,17 +734,18 @@ def to_hostnames(nodelist):
     return hostnames
 
 
+_RETRYABLE_ERRORS = re.compile(r"Rate Limit Exceeded|Quota Exceeded")
+# http status codes of transient errors worth retrying
+_RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+
 def retry_exception(exc):
     """return true for exceptions that should always be retried"""
-    retry_errors = (
-        "Rate Limit Exceeded",
-        "Quota Exceeded",
-    )
-    return any(e in str(exc) for e in retry_errors)
+    return _RETRYABLE_ERRORS.search(str(exc)) is not None
 
 
-def ensure_execute(request):
-    """Handle rate limits and socket time outs"""
+def ensure_execute(request, max_retries=10):
+    """Handle rate limits, transient server errors and socket time outs"""
 
     retry = 0
     wait = 1
@@ -662,51 +755,61 @@ def ensure_execute(request):
             return request.execute()
 
         except googleapiclient.errors.HttpError as e:
-            if retry_exception(e):
-                retry += 1
-                wait = min(wait * 2, max_wait)
-                log.error(f"retry:{retry} sleep:{wait} '{e}'")
-                sleep(wait)
-                continue
-            raise
+            # check the http status first, it avoids formatting the message
+            if retry >= max_retries or not (
+                e.resp.status in _RETRYABLE_STATUS or retry_exception(e)
+            ):
+                raise
+            error = e
 
         except socket.timeout as e:
             # socket timed out, try again
-            log.debug(e)
+            if retry >= max_retries:
+                raise
+            error = e
 
         except Exception as e:
             log.error(e, exc_info=True)
             raise
 
-        break
+        retry += 1
+        wait = min(wait * 2, max_wait)
+        # jitter so concurrent clients don't retry in lockstep
+        jittered = wait + random.uniform(0, wait)
+        log.error(f"retry:{retry} sleep:{jittered:.1f} '{error}'")
+        sleep(jittered)
 
 
-def batch_execute(requests, compute=compute, retry_cb=None):
+def batch_execute(requests, compute=None, retry_cb=None):
     """execute list or dict<req_id, request> as batch requests
     retry if retry_cb returns true
     """
     BATCH_LIMIT = 1000
+    _, compute = _api_handles(compute=compute)
     if not isinstance(requests, dict):
         requests = {str(k): v for k, v in enumerate(requests)}  # rid generated here
     done = {}
     failed = {}
+    pending = {}
     timestamps = []
     rate_limited = False
 
     def batch_callback(rid, resp, exc):
         nonlocal rate_limited
+        req = pending.pop(rid)
         if exc is not None:
             log.error(f"compute request exception {rid}: {exc}")
             if retry_exception(exc):
                 rate_limited = True
+                requests[rid] = req
             else:
-                req = requests.pop(rid)
                 failed[rid] = (req, exc)
         else:
             # if retry_cb is set, don't move to done until it returns false
             if retry_cb is None or not retry_cb(resp):
-                requests.pop(rid)
                 done[rid] = resp
+            else:
+                requests[rid] = req
 
     def batch_request(reqs):
         batch = compute.new_batch_http_request(callback=batch_callback)
@@ -721,11 +824,13 @@ def batch_execute(requests, compute=compute, retry_cb=None):
             stamp = next(iter(timestamps))
             sleep(max(stamp - time(), 0))
             rate_limited = False
-        # up to API_REQ_LIMIT (2000) requests
+        # take up to API_REQ_LIMIT (2000) requests out of the queue so every
+        # round makes progress; callbacks put back only those to be retried
+        for rid in list(islice(requests, API_REQ_LIMIT)):
+            pending[rid] = requests.pop(rid)
         # in chunks of up to BATCH_LIMIT (1000)
         batches = [
-            batch_request(chunk)
-            for chunk in chunked(islice(requests.items(), API_REQ_LIMIT), BATCH_LIMIT)
+            batch_request(chunk) for chunk in ichunked(pending.items(), BATCH_LIMIT)
         ]
         timestamps.append(time() + 100)
         with ThreadPoolExecutor() as exe:
@@ -737,12 +842,16 @@ def batch_execute(requests, compute=compute, retry_cb=None):
                 result = future.exception()
                 if result is not None:
                     raise result
+        # anything without a callback is submitted again
+        requests.update(pending)
+        pending.clear()
 
     return done, failed
 
 
-def wait_request(operation, project=project, compute=compute):
+def wait_request(operation, project=None, compute=None):
     """makes the appropriate wait request for a given operation"""
+    project, compute = _api_handles(project, compute)
     if "zone" in operation:
         req = compute.zoneOperations().wait(
             project=project,
@@ -762,11 +871,12 @@ def wait_request(operation, project=project, compute=compute):
     return req
 
 
-def wait_for_operation(operation, project=project, compute=compute):
+def wait_for_operation(operation, project=None, compute=None):
     """wait for given operation"""
-    wait_req = wait_request(operation)
-
     while True:
+        # wait blocks server-side for up to 2 minutes, so a fresh request is
+        # only issued if the operation is still not done after that
+        wait_req = wait_request(operation, project=project, compute=compute)
         result = ensure_execute(wait_req)
         if result["status"] == "DONE":
             log_errors = " with errors" if "error" in result else ""
@@ -776,18 +886,23 @@ def wait_for_operation(operation, project=project, compute=compute):
             return result
 
 
-def wait_for_operations(operations, project=project, compute=compute):
-    return [wait_for_operation(op) for op in operations]
+def wait_for_operations(operations, project=None, compute=None):
+    """wait for all operations in parallel, results are in the given order
+    a failure is raised once all other waits have finished
+    """
+    wait_op = partial(wait_for_operation, project=project, compute=compute)
+    with ThreadPoolExecutor(max_workers=MAX_WAIT_WORKERS) as exe:
+        return list(exe.map(wait_op, operations))
 
 
-def wait_for_operations_async(operations, project=project, compute=compute):
+def wait_for_operations_async(operations, project=None, compute=None):
     """wait for all operations"""
 
     def operation_retry(resp):
         return resp["status"] != "DONE"
 
-    requests = [wait_request(op) for op in operations]
-    return batch_execute(requests, retry_cb=operation_retry)
+    requests = [wait_request(op, project=project, compute=compute) for op in operations]
+    return batch_execute(requests, compute=compute, retry_cb=operation_retry)
 
 
 def get_filtered_operations(
@@ -795,10 +910,11 @@ def get_filtered_operations(
     zone=None,
     region=None,
     only_global=False,
-    project=project,
-    compute=compute,
+    project=None,
+    compute=None,
 ):
     """get list of operations associated with group id"""
+    project, compute = _api_handles(project, compute)
 
     operations = []
 
@@ -840,22 +956,19 @@ def get_filtered_operations(
     return operations
 
 
-def get_insert_operations(bulk_operations, project=project, compute=compute):
+def get_insert_operations(bulk_operations, project=None, compute=None):
     """get all group operations from list of bulk operations"""
     flt = " OR ".join(
         f"(operationGroupId={op['operationGroupId']})" for op in bulk_operations
     )
-    return get_filtered_operations(f"(operationType=insert) AND ({flt})")
+    return get_filtered_operations(
+        f"(operationType=insert) AND ({flt})", project=project, compute=compute
+    )
 
 
-class Dumper(yaml.SafeDumper):
+class Dumper(SafeDumper):
     """Add representers for pathlib.Path and NSDict for yaml serialization"""
 
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.add_representer(NSDict, self.represent_nsdict)
-        self.add_multi_representer(Path, self.represent_path)
-
     @staticmethod
     def represent_nsdict(dumper, data):
         return dumper.represent_mapping("tag:yaml.org,2002:map", data.items())
@@ -865,6 +978,20 @@ class Dumper(yaml.SafeDumper):
         return dumper.represent_scalar("tag:yaml.org,2002:str", str(path))
 
 
+# registered once on the class rather than on every Dumper instance
+Dumper.add_representer(NSDict, Dumper.represent_nsdict)
+Dumper.add_multi_representer(Path, Dumper.represent_path)
+
+
+# field projections for aggregatedList calls
+_INSTANCE_FIELDS = (
+    "items.zones.instances(name,zone,status,machineType,metadata),nextPageToken"
+)
+_MACHINE_FIELDS = (
+    "items.zones.machineTypes(name,zone,guestCpus,memoryMb,accelerators),nextPageToken"
+)
+
+
 class Lookup:
     """Wrapper class for cached data access"""
 
@@ -930,11 +1057,31 @@ class Lookup:
     def enable_job_exclusive(self):
         return bool(self.cfg.enable_job_exclusive or self.cfg.enable_placement)
 
-    @lru_cache(maxsize=None)
+    @lru_cache(maxsize=65536)
     def _node_desc(self, node_name):
         """Get parts from node name"""
         if not node_name:
             node_name = self.hostname
+        # fast path for the common <name>-<partition>-<group>-<index> form,
+        # anything else (e.g. a node range) goes through the regex
+        prefix, _, index = node_name.rpartition("-")
+        parts = prefix.split("-", 2)
+        if (
+            index.isdecimal()
+            and len(parts) == 3
+            and all(parts)
+            and node_name.split() == [node_name]
+        ):
+            name, partition, group = parts
+            return NSDict(
+                prefix=prefix,
+                name=name,
+                partition=partition,
+                group=group,
+                node=index,
+                index=index,
+                range=None,
+            )
         m = self.node_desc_regex.match(node_name)
         if not m:
             raise Exception(f"node name {node_name} is not valid")
@@ -1019,12 +1166,9 @@ class Lookup:
     def instances(self, project=None, slurm_cluster_name=None):
         slurm_cluster_name = slurm_cluster_name or self.cfg.slurm_cluster_name
         project = project or self.project
-        fields = (
-            "items.zones.instances(name,zone,status,machineType,metadata),nextPageToken"
-        )
         flt = f"name={slurm_cluster_name}-*"
         act = self.compute.instances()
-        op = act.aggregatedList(project=project, fields=fields, filter=flt)
+        op = act.aggregatedList(project=project, fields=_INSTANCE_FIELDS, filter=flt)
 
         def properties(inst):
             """change instance properties to a preferred format"""
@@ -1040,13 +1184,12 @@ class Lookup:
         instances = {}
         while op is not None:
             result = ensure_execute(op)
+            # zones without matching instances have no "instances" key
             instances.update(
-                {
-                    inst["name"]: properties(inst)
-                    for inst in chain.from_iterable(
-                        m["instances"] for m in result["items"].values()
-                    )
-                }
+                (inst["name"], properties(inst))
+                for inst in chain.from_iterable(
+                    m.get("instances", ()) for m in result.get("items", {}).values()
+                )
             )
             op = act.aggregatedList_next(op, result)
         return instances
@@ -1067,18 +1210,14 @@ class Lookup:
     @lru_cache(maxsize=1)
     def machine_types(self, project=None):
         project = project or self.project
-        field_names = "name,zone,guestCpus,memoryMb,accelerators"
-        fields = f"items.zones.machineTypes({field_names}),nextPageToken"
 
         machines = defaultdict(dict)
         act = self.compute.machineTypes()
-        op = act.aggregatedList(project=project, fields=fields)
+        op = act.aggregatedList(project=project, fields=_MACHINE_FIELDS)
         while op is not None:
             result = ensure_execute(op)
             machine_iter = chain.from_iterable(
-                m["machineTypes"]
-                for m in result["items"].values()
-                if "machineTypes" in m
+                m.get("machineTypes", ()) for m in result.get("items", {}).values()
             )
             for machine in machine_iter:
                 name = machine["name"]
@@ -1088,16 +1227,26 @@ class Lookup:
             op = act.aggregatedList_next(op, result)
         return machines
 
+    @lru_cache(maxsize=None)
     def machine_type(self, machine_type, project=None, zone=None):
-        """ """
+        """get machine type info, pass zone when known to skip listing all
+        machine types in all zones
+        """
+        machine_info = None
         if zone:
-            project = project or self.project
-            machine_info = ensure_execute(
-                self.compute.machineTypes().get(
-                    project=project, zone=zone, machineType=machine_type
+            try:
+                machine_info = ensure_execute(
+                    self.compute.machineTypes().get(
+                        project=project or self.project,
+                        zone=zone,
+                        machineType=machine_type,
+                    )
                 )
-            )
-        else:
+            except googleapiclient.errors.HttpError as e:
+                # not offered in that zone, fall back to searching all zones
+                if e.resp.status != 404:
+                    raise
+        if machine_info is None:
             machines = self.machine_types(project=project)
             machine_info = next(iter(machines[machine_type].values()), None)
             if machine_info is None:
@@ -1134,6 +1283,17 @@ class Lookup:
                 if template_name in cache:
                     return NSDict(cache[template_name])
 
+        template = self._fetch_template_info(template_link, project)
+
+        # keep write access open for minimum time
+        with shelve.open(str(self.template_cache_path), writeback=True) as cache:
+            cache[template_name] = template.to_dict()
+
+        return template
+
+    def _fetch_template_info(self, template_link, project):
+        """get template info from the api, bypassing the template cache"""
+        template_name = template_link.split("/")[-1]
         template = ensure_execute(
             self.compute.instanceTemplates().get(
                 project=project, instanceTemplate=template_name
@@ -1153,11 +1313,6 @@ class Lookup:
         else:
             template.gpu_type = None
             template.gpu_count = 0
-
-        # keep write access open for minimum time
-        with shelve.open(str(self.template_cache_path), writeback=True) as cache:
-            cache[template_name] = template.to_dict()
-
         return template
 
     @lru_cache(maxsize=None)
@@ -1172,6 +1327,37 @@ class Lookup:
                 sleep(0.1)
                 continue
 
+    def _prefetch_templates(self, template_links, project):
+        if self.template_cache_path.exists():
+            with shelve.open(str(self.template_cache_path), flag="r") as cache:
+                template_links = [
+                    link for link in template_links if link.split("/")[-1] not in cache
+                ]
+        if not template_links:
+            return
+        # only the api calls run concurrently, the cache is used from this thread
+        fetch = partial(self._fetch_template_info, project=project)
+        with ThreadPoolExecutor() as exe:
+            templates = list(exe.map(fetch, template_links))
+        with shelve.open(str(self.template_cache_path), writeback=True) as cache:
+            for template in templates:
+                cache[template.name] = template.to_dict()
+
+    def prefetch_templates(self, template_links, project=None):
+        """fill the template cache, fetching each distinct template that is
+        missing from it once
+        """
+        project = project or self.project
+        template_links = set(template_links)
+
+        # In the event of concurrent write access to the cache, _prefetch_templates could fail
+        while True:
+            try:
+                return self._prefetch_templates(template_links, project)
+            except OSError:
+                sleep(0.1)
+                continue
+
     @lru_cache(maxsize=1)
     def subscriptions(slef, project=None, slurm_cluster_name=None):
         return subscription_list(